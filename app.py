@@ -1,9 +1,17 @@
 from flask import Flask, render_template, request, redirect, url_for, make_response
 from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import (PyMongoError, ConnectionFailure, NetworkTimeout,
+                            OperationFailure, BulkWriteError)
+from bson import json_util
+from bson.errors import InvalidDocument
 from bson.objectid import ObjectId
 from datetime import datetime, date as _date, timedelta
 from dateutil.relativedelta import relativedelta
 import os
+import sqlite3
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
 
 load_dotenv()  # works locally, ignored on Railway (safe)
@@ -23,10 +31,37 @@ app.secret_key = SECRET_KEY or "default-secret"
 client = MongoClient(MONGO_URI)
 db = client["rkm_locker_db"]
 
+# the payment desk reads through its own client with short timeouts, so a slow
+# link fails fast instead of freezing the page
+DESK_MONGO_TIMEOUT_MS = int(os.environ.get("DESK_MONGO_TIMEOUT_MS", "3000"))
+desk_client = MongoClient(
+    MONGO_URI,
+    serverSelectionTimeoutMS=DESK_MONGO_TIMEOUT_MS,
+    connectTimeoutMS=DESK_MONGO_TIMEOUT_MS,
+    socketTimeoutMS=DESK_MONGO_TIMEOUT_MS
+)
+desk_db = desk_client["rkm_locker_db"]
+
+# the payment queue worker has its own client too, with timeouts well inside
+# PAYMENT_QUEUE_LEASE so a stalled link can't hold claimed rows past the lease
+SYNC_MONGO_TIMEOUT_MS = int(os.environ.get("SYNC_MONGO_TIMEOUT_MS", "20000"))
+sync_client = MongoClient(
+    MONGO_URI,
+    serverSelectionTimeoutMS=SYNC_MONGO_TIMEOUT_MS,
+    connectTimeoutMS=SYNC_MONGO_TIMEOUT_MS,
+    socketTimeoutMS=SYNC_MONGO_TIMEOUT_MS
+)
+sync_db = sync_client["rkm_locker_db"]
+
 # ---------- Collections ----------
 lockers = db.lockers
 payments = db.payments
 counters = db.counters
+desk_lockers = desk_db.lockers
+desk_payments = desk_db.payments
+sync_lockers = sync_db.lockers
+sync_payments = sync_db.payments
+sync_counters = sync_db.counters
 
 
 
@@ -50,10 +85,11 @@ def _id_repr(doc):
 
 
 
-def get_next_sequence(name):
-    seq = counters.find_one_and_update(
+def get_next_sequence(name, step=1, collection=None):
+    """Bump counter `name` by `step` and return the new (last allocated) value."""
+    seq = (collection if collection is not None else counters).find_one_and_update(
         {"_id": name},
-        {"$inc": {"seq": 1}},
+        {"$inc": {"seq": step}},
         upsert=True,
         return_document=ReturnDocument.AFTER
     )
@@ -100,6 +136,12 @@ def normalize_to_date(dt_like):
                 return None
     return None
 
+def as_utc_naive(dt):
+    """Mongo hands back naive UTC datetimes; bring aware ones (e.g. from the local queue) in line."""
+    if isinstance(dt, datetime) and dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
 @app.template_filter('dateformat')
 def dateformat(value, fmt="%d/%m/%Y"):
     if value is None:
@@ -124,6 +166,589 @@ def dateformat(value, fmt="%d/%m/%Y"):
 def inject_now():
     return {"datetime": datetime, "date": _date}
 
+# ---------- Local payment queue ----------
+# Payments are committed to a local SQLite file first (with a provisional
+# receipt number) and flushed to Mongo in batches by a background worker, so
+# the desk never waits on a slow Atlas link and nothing is lost in an outage.
+# Row status: pending -> sent | duplicate | conflict (payment saved, locker
+# changed meanwhile so its update was skipped) | dead (rejected by Mongo).
+#
+# The queue file must live on persistent storage: on Railway attach a volume
+# (its mount path is picked up from RAILWAY_VOLUME_MOUNT_PATH) or point
+# PAYMENT_QUEUE_DB at a file on it. Without one, payments are refused.
+PAYMENT_QUEUE_DB = os.environ.get("PAYMENT_QUEUE_DB") or os.path.join(
+    os.environ.get("RAILWAY_VOLUME_MOUNT_PATH", "."), "payment_queue.db")
+PAYMENT_QUEUE_BATCH = int(os.environ.get("PAYMENT_QUEUE_BATCH", "50"))
+PAYMENT_QUEUE_INTERVAL = 2            # seconds between flushes when healthy
+PAYMENT_QUEUE_MAX_BACKOFF = 300       # seconds, cap for retry backoff while Mongo is down
+PAYMENT_QUEUE_MAX_REJECT_BACKOFF = 60 # seconds, cap for retry backoff after Mongo errors
+PAYMENT_QUEUE_PROBE_INTERVAL = 10     # seconds between connectivity probes while Mongo is down
+PAYMENT_QUEUE_LEASE = 120             # seconds a flusher holds the rows it claimed
+PAYMENT_QUEUE_MAX_FAILURES = 5        # permanent rejections before a row is dead-lettered
+PAYMENT_QUEUE_KEEP_SENT_DAYS = 30     # flushed rows kept locally for resubmits / receipts
+LOCKER_SNAPSHOT_INTERVAL = 300        # seconds between full refreshes of the local locker copy
+
+# locker fields make_payment needs when it has to work from the local copy
+LOCKER_SNAPSHOT_FIELDS = ("membership_id", "full_name", "locker_no", "mobile", "gender",
+                          "start_date", "end_date", "status", "no_late_fine")
+
+# locker fields a queued write must find unchanged to be applied; if the locker
+# is edited or reassigned before the flush, the write is flagged instead
+LOCKER_GUARD_FIELDS = ("membership_id", "start_date", "end_date")
+
+# server error codes retrying can never fix (invalid / rejected documents)
+PERMANENT_WRITE_ERROR_CODES = {2, 9, 14, 52, 55, 121, 10334}
+
+_queue_wakeup = threading.Event()
+_queue_worker_lock = threading.Lock()
+_queue_worker_pid = None
+
+
+def _queue_conn():
+    # autocommit mode; transactions are opened explicitly with BEGIN IMMEDIATE
+    conn = sqlite3.connect(PAYMENT_QUEUE_DB, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    return conn
+
+
+def init_payment_queue():
+    conn = _queue_conn()
+    try:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pending_payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                provisional_receipt_no TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                failures INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                lease_until REAL NOT NULL DEFAULT 0,
+                reserved_receipt_no INTEGER,
+                receipt_no INTEGER,
+                created_at REAL NOT NULL,
+                flushed_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS pending_payments_status ON pending_payments (status, id);
+            CREATE TABLE IF NOT EXISTS locker_snapshots (
+                locker_id TEXT PRIMARY KEY,
+                doc TEXT NOT NULL,
+                refreshed_at REAL NOT NULL
+            );
+        """)
+    finally:
+        conn.close()
+
+
+def payment_queue_storage_problem():
+    """Why queued payments could be lost on a redeploy, or None if the queue file is on persistent storage."""
+    volume = os.environ.get("RAILWAY_VOLUME_MOUNT_PATH")
+    path = os.path.abspath(PAYMENT_QUEUE_DB)
+    if volume:
+        if not path.startswith(os.path.join(os.path.abspath(volume), "")):
+            return f"payment queue file {path} is not on the volume mounted at {volume}"
+    elif os.environ.get("RAILWAY_ENVIRONMENT"):
+        return "no volume attached, queued payments would be lost on redeploy"
+    return None
+
+
+def _new_provisional_receipt_no():
+    # random rather than a local counter: these numbers are stored in Mongo
+    # next to every other deploy's, so they must never repeat
+    return "P-" + uuid.uuid4().hex[:10].upper()
+
+
+def locker_write_filter(doc):
+    """Filter for a queued locker write: the locker as `doc` saw it (see LOCKER_GUARD_FIELDS)."""
+    flt = {"_id": doc["_id"]}
+    for field in LOCKER_GUARD_FIELDS:
+        flt[field] = doc.get(field)
+    return flt
+
+
+def enqueue_payment(payment_doc, locker_writes):
+    """
+    Durably store a payment and its locker updates locally.
+    locker_writes: list of {"filter", "update", "many"} applied to `lockers` in order;
+    single-locker filters should come from locker_write_filter().
+    Sets and returns the provisional receipt number.
+    Raises sqlite3.IntegrityError if the idempotency key is already recorded.
+    """
+    provisional = _new_provisional_receipt_no()
+    payment_doc["receipt_no"] = provisional
+    payment_doc["provisional_receipt_no"] = provisional
+    payload = json_util.dumps({"payment": payment_doc, "writes": locker_writes})
+
+    conn = _queue_conn()
+    try:
+        conn.execute(
+            "INSERT INTO pending_payments (idempotency_key, provisional_receipt_no, payload, created_at) "
+            "VALUES (?, ?, ?, ?)",
+            (payment_doc["idempotency_key"], provisional, payload, time.time())
+        )
+    finally:
+        conn.close()
+
+    _queue_wakeup.set()
+    return provisional
+
+
+def _row_payment(payload, status, receipt_no):
+    pay = json_util.loads(payload)["payment"]
+    if receipt_no is not None:
+        pay["receipt_no"] = receipt_no
+    pay["sync_status"] = status
+    return pay
+
+
+def find_queued_payment(idempotency_key=None, provisional_receipt_no=None):
+    """Return the locally recorded payment (any status) matching either key, or None."""
+    if idempotency_key:
+        column, value = "idempotency_key", idempotency_key
+    else:
+        column, value = "provisional_receipt_no", provisional_receipt_no
+    conn = _queue_conn()
+    try:
+        row = conn.execute(
+            f"SELECT payload, status, receipt_no FROM pending_payments WHERE {column} = ?", (value,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return _row_payment(*row) if row else None
+
+
+def unsynced_payments():
+    """Payments taken at the desk that are not in Mongo yet (queued or dead-lettered)."""
+    conn = _queue_conn()
+    try:
+        rows = conn.execute(
+            "SELECT payload, status, receipt_no FROM pending_payments "
+            "WHERE status IN ('pending', 'dead') ORDER BY id"
+        ).fetchall()
+    finally:
+        conn.close()
+    return [_row_payment(*r) for r in rows]
+
+
+def merge_unsynced_payments(pays, unsynced, match):
+    """
+    Add the `unsynced` payments accepted by `match` to a Mongo result, flagged
+    `provisional`. Read `unsynced` before querying Mongo: a row flushed in
+    between then shows up twice and is dropped here, rather than not at all.
+    """
+    seen = {p.get("idempotency_key") for p in pays}
+    for p in unsynced:
+        if p["idempotency_key"] not in seen and match(p):
+            p["provisional"] = True
+            pays.append(p)
+    pays.sort(key=lambda p: as_utc_naive(p.get("payment_date")) or datetime.min)
+    return pays
+
+
+def payment_queue_status():
+    """What the operator banner shows: queue depth, rows needing attention, last error."""
+    conn = _queue_conn()
+    try:
+        pending = conn.execute("SELECT COUNT(*) FROM pending_payments WHERE status = 'pending'").fetchone()[0]
+        last_error = conn.execute(
+            "SELECT last_error FROM pending_payments WHERE status = 'pending' "
+            "AND last_error IS NOT NULL ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        flagged = conn.execute(
+            "SELECT status, provisional_receipt_no, payload, last_error FROM pending_payments "
+            "WHERE status IN ('dead', 'conflict') ORDER BY id"
+        ).fetchall()
+    finally:
+        conn.close()
+
+    status = {"pending": pending, "last_error": last_error[0] if last_error else None,
+              "dead": [], "conflicts": [], "storage_problem": payment_queue_storage_problem()}
+    for row_status, provisional, payload, error in flagged:
+        pay = json_util.loads(payload)["payment"]
+        status["dead" if row_status == "dead" else "conflicts"].append({
+            "provisional_receipt_no": provisional,
+            "locker_no": pay.get("locker_no"),
+            "full_name": pay.get("full_name"),
+            "error": error
+        })
+    return status
+
+
+def requeue_dead_payments():
+    """Put dead-lettered payments back in the queue with a clean failure count."""
+    conn = _queue_conn()
+    try:
+        count = conn.execute(
+            "UPDATE pending_payments SET status = 'pending', failures = 0, lease_until = 0 "
+            "WHERE status = 'dead'"
+        ).rowcount
+    finally:
+        conn.close()
+    _queue_wakeup.set()
+    return count
+
+
+def resolve_locker_conflicts():
+    """Acknowledge payments whose locker update was skipped (the locker was fixed up by hand)."""
+    conn = _queue_conn()
+    try:
+        return conn.execute(
+            "UPDATE pending_payments SET status = 'sent' WHERE status = 'conflict'"
+        ).rowcount
+    finally:
+        conn.close()
+
+
+def _apply_update(doc, update):
+    doc.update(update.get("$set", {}))
+    for field in update.get("$unset", {}):
+        doc.pop(field, None)
+    return doc
+
+
+def apply_queued_locker_writes(doc):
+    """Overlay not-yet-flushed $set/$unset updates for this locker onto `doc`."""
+    conn = _queue_conn()
+    try:
+        rows = conn.execute(
+            "SELECT payload FROM pending_payments WHERE status = 'pending' ORDER BY id"
+        ).fetchall()
+    finally:
+        conn.close()
+    for (payload,) in rows:
+        for w in json_util.loads(payload)["writes"]:
+            if not w.get("many") and w["filter"].get("_id") == doc["_id"]:
+                _apply_update(doc, w["update"])
+    return doc
+
+
+def save_locker_snapshots(docs, replace_all=False):
+    rows = []
+    for d in docs:
+        snap = {k: d[k] for k in LOCKER_SNAPSHOT_FIELDS if k in d}
+        snap["_id"] = d["_id"]
+        rows.append((str(d["_id"]), json_util.dumps(snap), time.time()))
+    conn = _queue_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if replace_all:
+            conn.execute("DELETE FROM locker_snapshots")
+        conn.executemany("INSERT OR REPLACE INTO locker_snapshots VALUES (?, ?, ?)", rows)
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def load_locker_snapshot(locker_id):
+    conn = _queue_conn()
+    try:
+        row = conn.execute("SELECT doc FROM locker_snapshots WHERE locker_id = ?", (str(locker_id),)).fetchone()
+    finally:
+        conn.close()
+    return json_util.loads(row[0]) if row else None
+
+
+def refresh_locker_snapshots():
+    docs = list(sync_lockers.find({}, {k: 1 for k in LOCKER_SNAPSHOT_FIELDS}))
+    save_locker_snapshots(docs, replace_all=True)
+
+
+def _apply_writes_to_snapshots(conn, writes):
+    # keep the local copy in step with what was just flushed, so it stays
+    # right once the writes leave the queue (and the overlay)
+    for w in writes:
+        if w.get("many"):
+            continue
+        locker_id = str(w["filter"]["_id"])
+        row = conn.execute("SELECT doc FROM locker_snapshots WHERE locker_id = ?", (locker_id,)).fetchone()
+        if row:
+            snap = _apply_update(json_util.loads(row[0]), w["update"])
+            conn.execute("UPDATE locker_snapshots SET doc = ? WHERE locker_id = ?",
+                         (json_util.dumps(snap), locker_id))
+
+
+def find_locker_for_desk(locker_id):
+    """
+    Fetch a locker for the payment desk from Mongo (short desk timeout), falling
+    back to the local snapshot when Mongo is slow or unreachable. Queued writes
+    are overlaid either way. Returns (doc or None, offline).
+    """
+    try:
+        doc = desk_lockers.find_one({"_id": locker_id})
+        offline = False
+    except PyMongoError as e:
+        app.logger.warning("Mongo unreachable, using local snapshot for locker %s: %s", locker_id, e)
+        doc = load_locker_snapshot(locker_id)
+        offline = True
+    else:
+        if doc:
+            save_locker_snapshots([doc])
+
+    if doc:
+        apply_queued_locker_writes(doc)
+    return doc, offline
+
+
+def _is_permanent_error(e):
+    """True for errors retrying won't fix; timeouts, write concern and duplicate key races are retried."""
+    if isinstance(e, InvalidDocument):
+        return True
+    if isinstance(e, BulkWriteError):
+        codes = {err.get("code") for err in e.details.get("writeErrors", [])}
+        return bool(codes) and codes <= PERMANENT_WRITE_ERROR_CODES
+    if isinstance(e, OperationFailure):
+        return e.code in PERMANENT_WRITE_ERROR_CODES
+    return False
+
+
+def _check_deadline(deadline):
+    # stop before the lease runs out, so another process can't pick the rows up mid-write
+    if time.time() > deadline:
+        raise NetworkTimeout("payment queue lease about to expire, stopping this batch")
+
+
+def _locker_write_landed(w):
+    """True if an earlier, interrupted flush already applied this guarded write."""
+    doc = sync_lockers.find_one({"_id": w["filter"]["_id"]})
+    if not doc:
+        return False
+    expected = _apply_update({f: w["filter"].get(f) for f in LOCKER_GUARD_FIELDS}, w["update"])
+    return all(doc.get(f) == expected.get(f) for f in LOCKER_GUARD_FIELDS)
+
+
+def _apply_locker_writes(writes, deadline):
+    """Apply one payment's locker writes in order. Returns a conflict note, or None."""
+    for w in writes:
+        _check_deadline(deadline)
+        if w.get("many"):
+            sync_lockers.update_many(w["filter"], w["update"])
+            continue
+        res = sync_lockers.update_one(w["filter"], w["update"])
+        if res.matched_count == 0 and not _locker_write_landed(w):
+            return "locker was edited or reassigned before this payment synced; locker record not updated"
+    return None
+
+
+def _write_batch_to_mongo(conn, entries, deadline):
+    """
+    Write claimed queue entries ({"row_id", "reserved", "payment", "writes"}) to Mongo, oldest first.
+    Returns {row_id: (receipt_no, status, note)} with status "sent", "duplicate" or "conflict".
+    """
+    keys = [e["payment"]["idempotency_key"] for e in entries]
+    existing = {p["idempotency_key"]: p for p in sync_payments.find(
+        {"idempotency_key": {"$in": keys}},
+        {"idempotency_key": 1, "receipt_no": 1, "provisional_receipt_no": 1}
+    )}
+
+    # receipt numbers are reserved on the queue row before the insert and reused
+    # on retry, so failed or rejected batches don't leave gaps in the sequence
+    need = [e for e in entries if e["payment"]["idempotency_key"] not in existing and e["reserved"] is None]
+    if need:
+        first = get_next_sequence("receipt_no", len(need), sync_counters) - len(need) + 1
+        for offset, e in enumerate(need):
+            e["reserved"] = first + offset
+        conn.executemany("UPDATE pending_payments SET reserved_receipt_no = ? WHERE id = ?",
+                         [(e["reserved"], e["row_id"]) for e in need])
+
+    new_payments = []
+    for e in entries:
+        if e["payment"]["idempotency_key"] not in existing:
+            e["payment"]["receipt_no"] = e["reserved"]
+            new_payments.append(e["payment"])
+    if new_payments:
+        _check_deadline(deadline)
+        sync_payments.insert_many(new_payments, ordered=True)
+
+    results = {}
+    for e in entries:
+        found = existing.get(e["payment"]["idempotency_key"])
+        if found and found.get("provisional_receipt_no") != e["payment"]["provisional_receipt_no"]:
+            # a resubmission queued after the original reached Mongo:
+            # its locker writes are stale, the original applied its own
+            results[e["row_id"]] = (found.get("receipt_no"), "duplicate", None)
+            continue
+        # found with our own provisional number: an earlier flush of this row
+        # got the payment in, finish the locker writes
+        receipt_no = found.get("receipt_no") if found else e["reserved"]
+        conflict = _apply_locker_writes(e["writes"], deadline)
+        results[e["row_id"]] = (receipt_no, "conflict" if conflict else "sent", conflict)
+    return results
+
+
+def flush_payment_queue(limit=PAYMENT_QUEUE_BATCH):
+    """Push the oldest pending payments (up to `limit`) to Mongo. Returns how many were flushed."""
+    conn = _queue_conn()
+    try:
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT id, payload, reserved_receipt_no, lease_until FROM pending_payments "
+            "WHERE status = 'pending' ORDER BY id LIMIT ?",
+            (limit,)
+        ).fetchall()
+        # always flush from the head so locker updates land in order;
+        # if another process holds the head, leave it to them
+        if not rows or rows[0][3] > now:
+            conn.execute("COMMIT")
+            return 0
+        ids = [r[0] for r in rows]
+        marks = ",".join("?" * len(ids))
+        conn.execute(
+            f"UPDATE pending_payments SET lease_until = ?, attempts = attempts + 1 WHERE id IN ({marks})",
+            [now + PAYMENT_QUEUE_LEASE, *ids]
+        )
+        conn.execute("COMMIT")
+
+        entries = []
+        for row_id, payload, reserved, _ in rows:
+            entry = json_util.loads(payload)
+            entry.update(row_id=row_id, reserved=reserved)
+            entries.append(entry)
+
+        deadline = now + PAYMENT_QUEUE_LEASE - 2 * SYNC_MONGO_TIMEOUT_MS / 1000
+        try:
+            results = _write_batch_to_mongo(conn, entries, deadline)
+        except Exception as e:
+            # only count a permanent rejection against a row once it has been isolated
+            rejected = len(ids) == 1 and _is_permanent_error(e)
+            conn.execute(
+                f"UPDATE pending_payments SET last_error = ?, lease_until = 0, failures = failures + ? "
+                f"WHERE id IN ({marks})",
+                [str(e)[:500], int(rejected), *ids]
+            )
+            if rejected:
+                conn.execute(
+                    "UPDATE pending_payments SET status = 'dead' WHERE id = ? AND failures >= ?",
+                    (ids[0], PAYMENT_QUEUE_MAX_FAILURES)
+                )
+            raise
+
+        conn.execute("BEGIN IMMEDIATE")
+        for entry in entries:
+            receipt_no, status, note = results[entry["row_id"]]
+            conn.execute(
+                "UPDATE pending_payments SET status = ?, receipt_no = ?, last_error = ?, flushed_at = ?, "
+                "lease_until = 0 WHERE id = ?",
+                (status, receipt_no, note, time.time(), entry["row_id"])
+            )
+            if status == "sent":
+                _apply_writes_to_snapshots(conn, entry["writes"])
+        conn.execute("COMMIT")
+        return len(ids)
+    finally:
+        conn.close()
+
+
+def prune_payment_queue():
+    conn = _queue_conn()
+    try:
+        conn.execute(
+            "DELETE FROM pending_payments WHERE status IN ('sent', 'duplicate') AND flushed_at < ?",
+            (time.time() - PAYMENT_QUEUE_KEEP_SENT_DAYS * 86400,)
+        )
+    finally:
+        conn.close()
+
+
+def _mongo_reachable():
+    try:
+        desk_client.admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+def run_payment_queue_once(state):
+    """
+    One pass of the flush worker. `state` carries delay, isolate (rows left to
+    flush one at a time after a permanent rejection) and down between passes.
+    """
+    try:
+        if not state.get("indexed"):
+            sync_payments.create_index("idempotency_key", unique=True, sparse=True)
+            sync_payments.create_index("provisional_receipt_no", unique=True, sparse=True)
+            state["indexed"] = True
+        while True:
+            limit = 1 if state["isolate"] else PAYMENT_QUEUE_BATCH
+            flushed = flush_payment_queue(limit)
+            state["isolate"] = max(state["isolate"] - flushed, 0)
+            if flushed < limit:
+                break
+        if time.time() >= state.get("next_refresh", 0):
+            refresh_locker_snapshots()
+            prune_payment_queue()
+            state["next_refresh"] = time.time() + LOCKER_SNAPSHOT_INTERVAL
+        state.update(delay=PAYMENT_QUEUE_INTERVAL, down=False)
+    except ConnectionFailure as e:
+        state.update(delay=min(state["delay"] * 2, PAYMENT_QUEUE_MAX_BACKOFF), down=True)
+        app.logger.warning("Mongo unreachable, payment queue backing off %ss: %s", state["delay"], e)
+    except Exception as e:
+        if _is_permanent_error(e):
+            # flush one row at a time until the rejected row is dead-lettered
+            state["isolate"] = PAYMENT_QUEUE_BATCH
+        state.update(delay=min(state["delay"] * 2, PAYMENT_QUEUE_MAX_REJECT_BACKOFF), down=False)
+        app.logger.warning("payment queue flush failed, retrying in %ss: %s", state["delay"], e)
+    return state
+
+
+def _wait_for_next_pass(state):
+    if state["down"]:
+        # probe instead of sleeping out the whole backoff, so queued payments
+        # go out soon after the link comes back
+        deadline = time.time() + state["delay"]
+        while time.time() < deadline:
+            time.sleep(min(PAYMENT_QUEUE_PROBE_INTERVAL, max(deadline - time.time(), 0)))
+            if _mongo_reachable():
+                break
+    elif state["delay"] > PAYMENT_QUEUE_INTERVAL:
+        time.sleep(state["delay"])  # backing off: don't let new payments trigger early retries
+    else:
+        _queue_wakeup.wait(timeout=state["delay"])
+    _queue_wakeup.clear()
+
+
+def _payment_queue_worker():
+    state = {"delay": PAYMENT_QUEUE_INTERVAL, "isolate": 0, "down": False}
+    while True:
+        _wait_for_next_pass(state)
+        run_payment_queue_once(state)
+
+
+def start_payment_queue_worker():
+    """Start the flush worker once per process; safe to call repeatedly and after a fork."""
+    global _queue_worker_pid
+    with _queue_worker_lock:
+        if _queue_worker_pid == os.getpid():
+            return
+        _queue_worker_pid = os.getpid()
+        init_payment_queue()
+
+        problem = payment_queue_storage_problem()
+        if problem:
+            app.logger.error("Payment queue NOT started, payments are refused: %s", problem)
+            return
+        if not os.environ.get("PAYMENT_QUEUE_DB") and not os.environ.get("RAILWAY_VOLUME_MOUNT_PATH"):
+            app.logger.warning("PAYMENT_QUEUE_DB not set; queued payments are kept in %s, "
+                               "make sure it is on persistent storage", os.path.abspath(PAYMENT_QUEUE_DB))
+        threading.Thread(target=_payment_queue_worker, name="payment-queue", daemon=True).start()
+
+
+@app.before_request
+def _ensure_payment_queue_worker():
+    if _queue_worker_pid != os.getpid():
+        start_payment_queue_worker()
+
+
+@app.context_processor
+def inject_payment_queue_status():
+    return {"payment_queue": payment_queue_status()}
+
 # ---------- Routes ----------
 @app.route('/')
 def index():
@@ -182,8 +807,12 @@ def view_lockers():
 # ---------- Updated make_payment route ----------
 @app.route('/payment/<id>', methods=['GET', 'POST'])
 def make_payment(id):
-    doc = lockers.find_one({"_id": ObjectId(id)})
+    # falls back to the local copy when Mongo is down; payments still waiting
+    # in the queue are overlaid so back-to-back payments extend from the right end_date
+    doc, offline = find_locker_for_desk(ObjectId(id))
     if not doc:
+        if offline:
+            return "Server unreachable and no local copy of this locker yet. Please try again shortly.", 503
         return "Not found", 404
 
     # normalize existing end_date if present
@@ -192,6 +821,26 @@ def make_payment(id):
     existing_end_date = normalize_to_date(raw_end)
 
     if request.method == 'POST':
+        storage_problem = payment_queue_storage_problem()
+        if storage_problem:
+            return f"Payments are disabled until the payment queue is on persistent storage: {storage_problem}", 503
+
+        # same form submitted twice (double click / resubmit) -> show the original receipt
+        idempotency_key = request.form.get('idempotency_key', '').strip() or uuid.uuid4().hex
+        existing = find_queued_payment(idempotency_key=idempotency_key)
+        if not existing:
+            # only needed if the original was recorded by another process or a
+            # previous deploy's disk; if Mongo can't be asked, the flush still
+            # dedupes on this key and won't replay a duplicate's locker writes
+            if not offline:
+                try:
+                    existing = desk_payments.find_one({"idempotency_key": idempotency_key})
+                except PyMongoError as e:
+                    app.logger.warning("idempotency lookup for %s failed, flush will dedupe: %s",
+                                       idempotency_key, e)
+        if existing:
+            return render_template('receipt.html', payment=existing, receipt_date=existing.get('payment_date'))
+
         # parse submitted payment_date (datetime)
         pd_str = request.form.get('payment_date', '').strip()
         payment_dt = parse_date(pd_str) or  datetime.now(timezone.utc)
@@ -283,11 +932,11 @@ def make_payment(id):
             total_amount = int(round(base_total + key_missing_fine + charged_late_fine))
             computed_end_date = start_date + relativedelta(months=months)
 
-        # prepare payment document to save (server-side canonical)
-        receipt_no = get_next_sequence("receipt_no")
+        # prepare payment document to save (server-side canonical);
+        # receipt_no is provisional until the queue worker flushes it to Mongo
         payment_doc = {
             "locker_id": doc['_id'],
-            "receipt_no": receipt_no,
+            "idempotency_key": idempotency_key,
             "payment_date": payment_dt,
             "months": months,
             "monthly_fee_used": int(round(used_monthly_fee)),
@@ -308,51 +957,15 @@ def make_payment(id):
 
         }
 
-        # Insert payment
-        payments.insert_one(payment_doc)
-
-        # --- NEW: update locker with last_paid_months and last_payment_at (or clear on cancel) ---
-        try:
-            if is_cancel:
-                # clear months info on cancel to avoid stale display
-                lockers.update_one(
-                    {"_id": doc['_id']},
-                    {"$unset": {"last_paid_months": "", "last_payment_at": ""}}
-                )
-            else:
-                lockers.update_one(
-    {"_id": doc["_id"]},
-    {
-        "$set": {
-            "last_paid_months": int(months),
-            "last_payment_at": datetime.now(timezone.utc)
-        }
-    }
-)
-        except Exception as e:
-            print("WARN: failed to update locker with last_paid_months", e)
-        # --- end NEW update ---
-
-        # debug output
-        print("DEBUG payment saved:", {
-            "receipt_no": receipt_no,
-            "membership_id": doc.get('membership_id'),
-            "locker_no": doc.get('locker_no'),
-            "months": months,
-            "monthly_fee_used": used_monthly_fee,
-            "key_missing_fine": key_missing_fine,
-            "late_fine": charged_late_fine,
-            "total": total_amount,
-            "is_cancel": is_cancel
-        })
-
-        # Apply locker updates
+        # Locker updates, applied in order together with the payment
+        locker_writes = []
         if is_cancel:
+            # clear months info on cancel to avoid stale display,
             # clear assignment and make available
             orig_membership = doc.get('membership_id')
-            res = lockers.update_one(
-                {"_id": doc['_id']},
-                {
+            locker_writes.append({
+                "filter": locker_write_filter(doc),
+                "update": {
                     "$set": {
                         "status": "available",
                         "cancelled_at":  datetime.utcnow()
@@ -364,20 +977,22 @@ def make_payment(id):
                         "start_date": "",
                         "end_date": "",
                         "gender": "",
-                        "updated_at": ""
+                        "updated_at": "",
+                        "last_paid_months": "",
+                        "last_payment_at": ""
                     }
                 }
-            )
-            print(f"DEBUG cancel result for locker {_id_repr(doc)}: matched={res.matched_count}, modified={res.modified_count}")
+            })
 
             # Also clear any duplicates for same membership ID
             if orig_membership:
-                res2 = lockers.update_many(
-                    {
+                locker_writes.append({
+                    "many": True,
+                    "filter": {
                         "membership_id": {"$regex": f'^{orig_membership}$', "$options": "i"},
                         "_id": {"$ne": doc['_id']}
                     },
-                    {
+                    "update": {
                         "$set": {"status": "available", "cancelled_at":  datetime.utcnow()},
                         "$unset": {
                             "membership_id": "",
@@ -389,10 +1004,14 @@ def make_payment(id):
                             "updated_at": ""
                         }
                     }
-                )
-                print(f"DEBUG cleared duplicates for membership {orig_membership}: matched={res2.matched_count}, modified={res2.modified_count}")
+                })
 
         else:
+            update_fields = {
+                "last_paid_months": int(months),
+                "last_payment_at": datetime.now(timezone.utc)
+            }
+
             # Renew / extend only if monthly fee > 0
             try:
                 monthly_fee_num = float(used_monthly_fee)
@@ -403,15 +1022,24 @@ def make_payment(id):
                 # store start_date and end_date as datetimes at midnight
                 start_dt_dt = datetime.combine(start_date, datetime.min.time())
                 end_dt_dt = datetime.combine(computed_end_date, datetime.min.time()) if computed_end_date else None
-                update_fields = {
+                update_fields.update({
                     "start_date": start_dt_dt,
                     "end_date": end_dt_dt,
                     "status": "active",
                     "updated_at":  datetime.utcnow()
+                })
 
-                }
-                res = lockers.update_one({"_id": doc['_id']}, {"$set": update_fields})
-                print(f"DEBUG extend result: matched={res.matched_count}, modified={res.modified_count}, new_end={end_dt_dt}")
+            locker_writes.append({"filter": locker_write_filter(doc), "update": {"$set": update_fields}})
+
+        # Commit locally; the background worker pushes it to Mongo
+        try:
+            enqueue_payment(payment_doc, locker_writes)
+        except sqlite3.IntegrityError:
+            # the same form was submitted concurrently and the other request queued it first
+            existing = find_queued_payment(idempotency_key=idempotency_key)
+            if not existing:
+                raise
+            return render_template('receipt.html', payment=existing, receipt_date=existing.get('payment_date'))
 
         # render receipt (server canonical values)
         payment_doc['start_date'] = datetime.combine(start_date, datetime.min.time()) if start_date else None
@@ -420,7 +1048,8 @@ def make_payment(id):
         return render_template('receipt.html', payment=payment_doc, receipt_date=payment_dt)
 
     # GET -> show form
-    return render_template('make_payment.html', doc=doc, today=datetime.utcnow())
+    return render_template('make_payment.html', doc=doc, today=datetime.utcnow(),
+                           idempotency_key=uuid.uuid4().hex)
 
 
 
@@ -431,12 +1060,38 @@ def view_receipt(receipt_no):
         return "Receipt not found", 404
     return render_template('receipt.html', payment=pay, receipt_date=pay.get('payment_date'))
 
+@app.route('/receipt/provisional/<provisional_no>')
+def view_provisional_receipt(provisional_no):
+    pay = find_queued_payment(provisional_receipt_no=provisional_no)
+    if not pay:
+        pay = payments.find_one({"provisional_receipt_no": provisional_no})
+    if not pay:
+        return "Receipt not found", 404
+    return render_template('receipt.html', payment=pay, receipt_date=pay.get('payment_date'))
+
+@app.route('/payment_queue/requeue', methods=['POST'])
+def requeue_failed_payments():
+    requeue_dead_payments()
+    return redirect(request.referrer or url_for('dashboard'))
+
+@app.route('/payment_queue/resolve', methods=['POST'])
+def resolve_payment_conflicts():
+    resolve_locker_conflicts()
+    return redirect(request.referrer or url_for('dashboard'))
+
 @app.route('/monthly_report', methods=['GET', 'POST'])
 def monthly_report():
     if request.method == 'POST':
         from_date = parse_date(request.form['from_date'])
         to_date = parse_date(request.form['to_date'])
+        unsynced = unsynced_payments()
         pays = list(payments.find({"payment_date": {"$gte": from_date, "$lte": to_date}}).sort("payment_date", 1))
+
+        def in_range(p):
+            pd = as_utc_naive(p.get('payment_date'))
+            return bool(pd and from_date and to_date and from_date <= pd <= to_date)
+
+        pays = merge_unsynced_payments(pays, unsynced, in_range)
         total_sum = sum(p.get('total', 0) for p in pays)
         return render_template('monthly_report.html', pays=pays, total_sum=total_sum, from_date=from_date, to_date=to_date)
     return render_template('monthly_report.html', pays=None)
@@ -634,9 +1289,20 @@ def payment_history():
         if locker_no:
             query["locker_no"] = {"$regex": f'^{locker_no}$', "$options": "i"}
 
+        def matches(p):
+            if membership_id and str(p.get("membership_id") or "").lower() != membership_id.lower():
+                return False
+            if name and name.lower() not in str(p.get("full_name") or "").lower():
+                return False
+            if locker_no and str(p.get("locker_no") or "").lower() != locker_no.lower():
+                return False
+            return True
+
+        unsynced = unsynced_payments()
         payments_list = list(
             payments.find(query).sort("payment_date", 1)
         )
+        payments_list = merge_unsynced_payments(payments_list, unsynced, matches)
 
         if payments_list:
             summary["count"] = len(payments_list)
@@ -654,5 +1320,6 @@ def payment_history():
 
 
 if __name__ == "__main__":
+    start_payment_queue_worker()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,368 @@
+import os
+import re
+import sqlite3
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from pymongo.errors import (AutoReconnect, DuplicateKeyError, ExecutionTimeout,
+                            OperationFailure, ServerSelectionTimeoutError)
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/?connect=false")
+
+import app as locker_app  # noqa: E402
+
+
+class FakeCollection:
+    """Just enough of a pymongo collection for the payment queue."""
+
+    def __init__(self, docs=None):
+        self.docs = list(docs or [])
+        self.fail = None     # exception raised while set...
+        self.fail_on = None  # ...by every method, or only by this one
+
+    def _check(self, method):
+        if self.fail and self.fail_on in (None, method):
+            raise self.fail
+
+    def _matches(self, doc, flt):
+        for k, v in flt.items():
+            value = doc.get(k)
+            if isinstance(v, Regex):
+                if not re.search(v.pattern, str(value or ""), re.I if "i" in str(v.flags) else 0):
+                    return False
+            elif isinstance(v, dict) and "$in" in v:
+                if value not in v["$in"]:
+                    return False
+            elif isinstance(v, dict) and "$ne" in v:
+                if value == v["$ne"]:
+                    return False
+            elif value != v:
+                return False
+        return True
+
+    def _update(self, doc, update):
+        doc.update(update.get("$set", {}))
+        for field in update.get("$unset", {}):
+            doc.pop(field, None)
+
+    def find(self, flt=None, projection=None):
+        self._check("find")
+        return [d for d in self.docs if self._matches(d, flt or {})]
+
+    def find_one(self, flt):
+        self._check("find_one")
+        found = self.find(flt)
+        return dict(found[0]) if found else None
+
+    def find_one_and_update(self, flt, update, upsert=False, return_document=None):
+        self._check("find_one_and_update")
+        doc = next(iter(self.find(flt)), None)
+        if doc is None:
+            doc = dict(flt, seq=0)
+            self.docs.append(doc)
+        doc["seq"] += update["$inc"]["seq"]
+        return dict(doc)
+
+    def insert_many(self, docs, ordered=True):
+        self._check("insert_many")
+        self.docs.extend(dict(d) for d in docs)
+
+    def update_one(self, flt, update):
+        self._check("update_one")
+        targets = self.find(flt)[:1]
+        for doc in targets:
+            self._update(doc, update)
+        return SimpleNamespace(matched_count=len(targets))
+
+    def update_many(self, flt, update):
+        self._check("update_many")
+        targets = self.find(flt)
+        for doc in targets:
+            self._update(doc, update)
+        return SimpleNamespace(matched_count=len(targets))
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    locker_id = ObjectId()
+    lockers = FakeCollection([{"_id": locker_id, "locker_no": "5", "membership_id": "M1",
+                               "full_name": "A", "end_date": datetime(2026, 10, 1)}])
+    payments = FakeCollection()
+    fakes = {"sync_lockers": lockers, "desk_lockers": lockers,
+             "sync_payments": payments, "desk_payments": payments,
+             "sync_counters": FakeCollection()}
+    for name, fake in fakes.items():
+        monkeypatch.setattr(locker_app, name, fake)
+    monkeypatch.setattr(locker_app, "PAYMENT_QUEUE_DB", str(tmp_path / "queue.db"))
+    monkeypatch.setattr(locker_app, "_queue_worker_pid", os.getpid())  # no background worker
+    monkeypatch.delenv("RAILWAY_ENVIRONMENT", raising=False)
+    monkeypatch.delenv("RAILWAY_VOLUME_MOUNT_PATH", raising=False)
+    locker_app.init_payment_queue()
+    fakes.update(lockers=lockers, payments=payments, counters=fakes["sync_counters"], locker_id=locker_id)
+    return fakes
+
+
+def _enqueue(queue, key, end_date, extra_writes=()):
+    locker = queue["lockers"].find_one({"_id": queue["locker_id"]})
+    payment = {"idempotency_key": key, "locker_id": locker["_id"], "total": 200,
+               "locker_no": locker.get("locker_no"), "payment_date": datetime(2026, 10, 19)}
+    writes = [{"filter": locker_app.locker_write_filter(locker), "update": {"$set": {"end_date": end_date}}}]
+    return locker_app.enqueue_payment(payment, writes + list(extra_writes))
+
+
+def _status(key):
+    conn = locker_app._queue_conn()
+    try:
+        return conn.execute(
+            "SELECT status, failures, receipt_no FROM pending_payments WHERE idempotency_key = ?", (key,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+
+def _queued_rows():
+    conn = locker_app._queue_conn()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM pending_payments").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_enqueue_then_flush(queue):
+    provisional = _enqueue(queue, "k1", datetime(2026, 12, 19))
+    assert provisional.startswith("P-") and provisional != _enqueue(queue, "k2", datetime(2026, 12, 19))
+
+    assert locker_app.flush_payment_queue() == 2
+    assert [p["receipt_no"] for p in queue["payments"].docs] == [1, 2]
+    assert queue["payments"].docs[0]["provisional_receipt_no"] == provisional
+    assert _status("k1") == ("sent", 0, 1)
+    assert locker_app.unsynced_payments() == []
+
+
+def test_same_key_cannot_be_queued_twice(queue):
+    _enqueue(queue, "k1", None)
+    with pytest.raises(sqlite3.IntegrityError):
+        _enqueue(queue, "k1", None)
+    assert locker_app.find_queued_payment(idempotency_key="k1")["sync_status"] == "pending"
+
+
+def test_queued_writes_are_overlaid(queue):
+    _enqueue(queue, "k1", datetime(2026, 12, 19))
+    doc, offline = locker_app.find_locker_for_desk(queue["locker_id"])
+    assert not offline
+    assert doc["end_date"] == datetime(2026, 12, 19)
+
+
+def test_offline_lookup_uses_snapshot(queue):
+    locker_app.find_locker_for_desk(queue["locker_id"])  # online: snapshot saved
+    _enqueue(queue, "k1", datetime(2026, 12, 19))
+    queue["lockers"].fail = ServerSelectionTimeoutError("down")
+
+    doc, offline = locker_app.find_locker_for_desk(queue["locker_id"])
+    assert offline
+    assert doc["membership_id"] == "M1"
+    assert doc["end_date"] == datetime(2026, 12, 19)
+
+
+def test_retry_after_partial_failure(queue):
+    _enqueue(queue, "k1", datetime(2026, 12, 19))
+    queue["lockers"].fail, queue["lockers"].fail_on = AutoReconnect("link dropped"), "update_one"
+    with pytest.raises(AutoReconnect):
+        locker_app.flush_payment_queue()
+    assert len(queue["payments"].docs) == 1  # payment got in, locker write did not
+    assert _status("k1")[0] == "pending"
+
+    queue["lockers"].fail = None
+    assert locker_app.flush_payment_queue() == 1
+    assert len(queue["payments"].docs) == 1
+    assert queue["lockers"].docs[0]["end_date"] == datetime(2026, 12, 19)
+    assert _status("k1") == ("sent", 0, 1)
+
+
+def test_retry_recognises_its_own_applied_locker_write(queue):
+    clear_duplicates = {"many": True, "filter": {"membership_id": "nobody"}, "update": {"$set": {"status": "x"}}}
+    _enqueue(queue, "k1", datetime(2026, 12, 19), [clear_duplicates])
+    queue["lockers"].fail, queue["lockers"].fail_on = AutoReconnect("link dropped"), "update_many"
+    with pytest.raises(AutoReconnect):
+        locker_app.flush_payment_queue()
+
+    queue["lockers"].fail = None
+    assert locker_app.flush_payment_queue() == 1
+    assert _status("k1")[0] == "sent"
+
+
+def test_resubmitted_duplicate_does_not_replay_locker_writes(queue):
+    queue["payments"].docs.append({"idempotency_key": "k1", "receipt_no": 7, "provisional_receipt_no": "P-OTHER"})
+    _enqueue(queue, "k1", datetime(2027, 3, 1))
+
+    assert locker_app.flush_payment_queue() == 1
+    assert queue["lockers"].docs[0]["end_date"] == datetime(2026, 10, 1)
+    assert _status("k1") == ("duplicate", 0, 7)
+
+
+def test_locker_changed_before_flush_is_flagged_not_overwritten(queue):
+    _enqueue(queue, "k1", datetime(2026, 12, 19))
+    queue["lockers"].docs[0].update(membership_id="M2", full_name="B")  # reassigned meanwhile
+
+    assert locker_app.flush_payment_queue() == 1
+    assert queue["lockers"].docs[0]["end_date"] == datetime(2026, 10, 1)
+    assert len(queue["payments"].docs) == 1  # the payment itself is kept
+    assert _status("k1")[0] == "conflict"
+    assert len(locker_app.payment_queue_status()["conflicts"]) == 1
+
+    assert locker_app.resolve_locker_conflicts() == 1
+    assert locker_app.payment_queue_status()["conflicts"] == []
+
+
+def test_permanent_rejection_is_dead_lettered_and_can_be_requeued(queue):
+    _enqueue(queue, "bad", None)
+    queue["payments"].fail = OperationFailure("document failed validation", 121)
+    for _ in range(locker_app.PAYMENT_QUEUE_MAX_FAILURES):
+        with pytest.raises(OperationFailure):
+            locker_app.flush_payment_queue(limit=1)
+    assert _status("bad")[0] == "dead"
+    assert len(locker_app.payment_queue_status()["dead"]) == 1
+
+    queue["payments"].fail = None
+    _enqueue(queue, "good", datetime(2026, 12, 19))
+    assert locker_app.flush_payment_queue() == 1
+    assert _status("good")[0] == "sent"
+
+    assert locker_app.requeue_dead_payments() == 1
+    assert _status("bad") == ("pending", 0, None)
+    assert locker_app.flush_payment_queue() == 1
+    # the payment is saved; its locker write is stale after "good" and gets flagged
+    assert _status("bad")[0] == "conflict"
+    assert len(queue["payments"].docs) == 2
+
+
+@pytest.mark.parametrize("error", [
+    AutoReconnect("down"),
+    ExecutionTimeout("operation exceeded time limit", 50),
+    DuplicateKeyError("E11000 duplicate key", 11000),
+])
+def test_transient_errors_do_not_dead_letter(queue, error):
+    _enqueue(queue, "k1", None)
+    queue["payments"].fail = error
+    for _ in range(locker_app.PAYMENT_QUEUE_MAX_FAILURES + 1):
+        with pytest.raises(type(error)):
+            locker_app.flush_payment_queue(limit=1)
+    assert _status("k1") == ("pending", 0, None)
+    assert locker_app.payment_queue_status()["pending"] == 1
+
+
+def test_failed_batches_leave_no_gaps_in_receipt_numbers(queue):
+    _enqueue(queue, "k1", datetime(2026, 12, 19))
+    _enqueue(queue, "k2", datetime(2026, 12, 19))
+    queue["payments"].fail, queue["payments"].fail_on = AutoReconnect("down"), "insert_many"
+    for _ in range(3):
+        with pytest.raises(AutoReconnect):
+            locker_app.flush_payment_queue()
+
+    queue["payments"].fail = None
+    assert locker_app.flush_payment_queue() == 2
+    assert [p["receipt_no"] for p in queue["payments"].docs] == [1, 2]
+    assert queue["counters"].docs[0]["seq"] == 2
+
+
+def test_worker_isolates_rows_after_rejection_and_backs_off(queue):
+    _enqueue(queue, "k1", None)
+    state = {"delay": locker_app.PAYMENT_QUEUE_INTERVAL, "isolate": 0, "down": False}
+
+    queue["payments"].fail = OperationFailure("document failed validation", 121)
+    locker_app.run_payment_queue_once(state)
+    assert state["isolate"] == locker_app.PAYMENT_QUEUE_BATCH
+    assert state["delay"] == locker_app.PAYMENT_QUEUE_INTERVAL * 2 and not state["down"]
+
+    queue["payments"].fail = AutoReconnect("down")
+    locker_app.run_payment_queue_once(state)
+    assert state["down"] and state["delay"] == locker_app.PAYMENT_QUEUE_INTERVAL * 4
+
+    queue["payments"].fail = None
+    locker_app.run_payment_queue_once(state)
+    assert state["delay"] == locker_app.PAYMENT_QUEUE_INTERVAL and not state["down"]
+    assert state["isolate"] == locker_app.PAYMENT_QUEUE_BATCH - 1
+    assert _status("k1")[0] == "sent"
+
+
+def test_reports_merge_unsynced_without_double_counting(queue):
+    _enqueue(queue, "k1", datetime(2026, 12, 19))
+    _enqueue(queue, "k2", datetime(2026, 12, 19))
+    unsynced = locker_app.unsynced_payments()
+    locker_app.flush_payment_queue(limit=1)  # k1 reaches Mongo between the two reads
+
+    merged = locker_app.merge_unsynced_payments(list(queue["payments"].docs), unsynced, lambda p: True)
+    assert [(p["idempotency_key"], bool(p.get("provisional"))) for p in merged] == [("k1", False), ("k2", True)]
+
+
+# ---------- make_payment route ----------
+
+def _pay(client, queue, key, **form):
+    data = {"payment_date": "2026-10-19", "months": "2", "idempotency_key": key}
+    data.update(form)
+    return client.post(f"/payment/{queue['locker_id']}", data=data)
+
+
+def test_route_queues_payment_and_resubmit_shows_original_receipt(queue):
+    client = locker_app.app.test_client()
+    first = _pay(client, queue, "k1")
+    assert first.status_code == 200
+    provisional = locker_app.find_queued_payment(idempotency_key="k1")["provisional_receipt_no"]
+    assert provisional.encode() in first.data
+
+    again = _pay(client, queue, "k1", months="6")
+    assert again.status_code == 200
+    assert provisional.encode() in again.data
+    assert _queued_rows() == 1
+
+
+def test_route_concurrent_double_submit_renders_queued_receipt(queue, monkeypatch):
+    client = locker_app.app.test_client()
+    _pay(client, queue, "k1")
+    provisional = locker_app.find_queued_payment(idempotency_key="k1")["provisional_receipt_no"]
+
+    # the second request passed its idempotency check before the first one queued
+    real_find = locker_app.find_queued_payment
+    calls = []
+
+    def racing_find(**kwargs):
+        calls.append(kwargs)
+        return None if len(calls) == 1 else real_find(**kwargs)
+
+    monkeypatch.setattr(locker_app, "find_queued_payment", racing_find)
+    monkeypatch.setattr(queue["payments"], "docs", [])
+    resp = _pay(client, queue, "k1")
+    assert resp.status_code == 200
+    assert provisional.encode() in resp.data
+    assert len(calls) == 2 and _queued_rows() == 1
+
+
+def test_route_offline_without_snapshot_returns_503(queue):
+    queue["lockers"].fail = ServerSelectionTimeoutError("down")
+    resp = _pay(locker_app.app.test_client(), queue, "k1")
+    assert resp.status_code == 503
+    assert _queued_rows() == 0
+
+
+def test_route_offline_with_snapshot_still_takes_payment(queue):
+    client = locker_app.app.test_client()
+    assert client.get(f"/payment/{queue['locker_id']}").status_code == 200  # snapshot saved
+    queue["lockers"].fail = ServerSelectionTimeoutError("down")
+    queue["payments"].fail = ServerSelectionTimeoutError("down")
+
+    resp = _pay(client, queue, "k1")
+    assert resp.status_code == 200
+    assert _status("k1")[0] == "pending"
+
+
+def test_route_refuses_payments_without_persistent_queue_storage(queue, monkeypatch):
+    monkeypatch.setenv("RAILWAY_ENVIRONMENT", "production")
+    resp = _pay(locker_app.app.test_client(), queue, "k1")
+    assert resp.status_code == 503
+    assert _queued_rows() == 0